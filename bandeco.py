@@ -1,16 +1,18 @@
 #!/bin/python3.12
 
 
-import argparse
 import datetime
-import requests
-import difflib
+import functools
 import pickle
-import json
 import sys
 import re
 import os
 
+try:
+  import msgspec
+except ImportError:
+  msgspec = None
+
 
 restaurants = [
   "PIRACICABA",                               # 01
@@ -39,6 +41,11 @@ restaurants = [
   "REGISTRO ESTORNO",                         # 24
 ]
 
+# Code of the default restaurant, "EACH SAO PAULO SP"
+DEFAULT_RESTAURANT = 13
+
+DEFAULT_MEAL = "dinner"
+
 
 verbose_mode: bool = False
 
@@ -49,52 +56,70 @@ def eprint(*args, **kwargs):
 
 HOME = os.path.expanduser("~")
 
+CACHE_DIR = os.path.join(HOME, ".cache", "bandeco")
+
 def open_cache(key:str, mode: str):
-  os.makedirs(f"{HOME}/.cache/bandeco", exist_ok=True)
-  return open(f"{HOME}/.cache/bandeco/{key}", mode)
+  # Reading never needs the directory to be created
+  if "r" not in mode:
+    os.makedirs(CACHE_DIR, exist_ok=True)
+  return open(os.path.join(CACHE_DIR, key), mode)
+
+
+# Line breaks, unicode escapes and any other backslash escape
+_SANITISE_RE = re.compile(r'<br>|\\u([0-9a-fA-F]{4})|\\(.)')
+
+_ESCAPES = {
+  "n"  : "\n",
+  "r"  : "\r",
+  "t"  : "\t",
+  "\\" : "",
+}
+
+def unescape_match(match: re.Match) -> str:
+  code, escaped = match.groups()
+  if code is not None:
+    return chr(int(code, 16))
+  elif escaped is not None:
+    return _ESCAPES.get(escaped, escaped)
+  else:
+    return "\n"
 
 
+_MEALS = {
+  "A": "lunch",
+  "J": "dinner",
+}
+
 def sanitise_entry(entry: tuple[str, str, str, str]):
   menu, date, meal, calories = entry
   
   # Sanitise the menu string
-  menu = (
-    menu
-    .replace("\\/", "/")
-    .encode().decode("unicode_escape")
-    .replace("<br>", "\n")
-    .replace("\\", "")
-  )
+  menu = _SANITISE_RE.sub(unescape_match, menu)
 
   # Sanitise the date string
   date = date.replace("\\", "")
 
   # Map the meal to its name
-  meal = {
-    "A": "lunch",
-    "J": "dinner",
-  }[meal]
+  meal = _MEALS[meal]
 
   # Convert the calories to an integer
   calories = int(calories)
 
-  return {
-    "menu"     : menu,
-    "date"     : date,
-    "meal"     : meal,
-    "calories" : calories,
-  }
+  # Key-value pairs for the dict constructor
+  return (f"{date}-{meal}", { 'menu': menu, 'calories': calories })
 
 
-def entry_to_key_value(entries: tuple[str, str, str, str]):
-  value = sanitise_entry(entries)
-  key = f"{value['date']}-{value['meal']}"
-  
-  # Key-value pairs for the dict constructor
-  return (key, { 'menu': value['menu'], 'calories': value['calories'] })
+_ENTRY_RE = re.compile(
+  r'cdpdia:"(.+?)",.*?'
+  r'dtarfi:"(.+?)",.*?'
+  r'tiprfi:"(\w)",.*?'
+  r'vlrclorfi:(\d+)'
+)
 
 
 def fetch_entries_http(restaurant: int) -> dict[str]:
+  import urllib.request
+
   data = (
     "callCount=1\n"
     "windowName=\n"
@@ -114,28 +139,44 @@ def fetch_entries_http(restaurant: int) -> dict[str]:
     "CardapioControleDWR.obterCardapioRestUSP.dwr"
   )
 
-  regex = (
-    r'cdpdia:"(.+?)",.*?'
-    r'dtarfi:"(.+?)",.*?'
-    r'tiprfi:"(\w)",.*?'
-    r'vlrclorfi:(\d+)'
-  )
-
   eprint("Requesting MENU over HTTP...")
-  response = requests.post(url, data)
+  request = urllib.request.Request(
+    url, data=data.encode(), method="POST",
+    headers={"Content-Type": "text/plain"},
+  )
+  with urllib.request.urlopen(request, timeout=10) as response:
+    charset = response.headers.get_content_charset() or "utf-8"
+    text = response.read().decode(charset)
 
-  entries = re.findall(regex, response.text)
+  matches = _ENTRY_RE.finditer(text)
+  entries = dict(sanitise_entry(match.groups()) for match in matches)
   eprint(f"- Request parsed ({len(entries)} entries)")
 
-  return dict(entry_to_key_value(entry) for entry in entries)
+  return entries
+
+
+if msgspec is not None:
+  _enc = msgspec.msgpack.Encoder()
+  _dec = msgspec.msgpack.Decoder(type=dict[str, dict])
+
+
+def decode_entries(raw: bytes) -> dict[str]:
+  if msgspec is not None:
+    try:
+      return _dec.decode(raw)
+    except msgspec.DecodeError as ex:
+      # Cache files written by older versions are pickled
+      eprint("- Not msgpack, trying pickle:", ex)
+  return pickle.loads(raw)
 
 
 def fetch_entries_cached(key: str) -> dict[str] | None:
   try:
     eprint(f'Attempting to open cache "{key}"...')
     with open_cache(key, "rb") as cache:
+      entries = decode_entries(cache.read())
       eprint("- Cache hit")
-      return pickle.load(cache)
+      return entries
   except Exception as ex:
     eprint("- Cache miss:", ex)
     return None
@@ -143,9 +184,33 @@ def fetch_entries_cached(key: str) -> dict[str] | None:
 
 def store_entries_cache(key: str, entries: dict[str]):
   with open_cache(key, "wb") as cache:
-    pickle.dump(entries, cache)
+    if msgspec is not None:
+      cache.write(_enc.encode(entries))
+    else:
+      pickle.dump(entries, cache, protocol=pickle.HIGHEST_PROTOCOL)
+
+
+# How long an empty HTTP response is trusted before asking the server again
+MISS_TTL = datetime.timedelta(hours=1)
+
+def is_known_missing(key: str) -> bool:
+  try:
+    with open_cache(f"{key}.miss", "rb") as sentinel:
+      mtime = os.fstat(sentinel.fileno()).st_mtime
+  except OSError:
+    return False
+
+  age = datetime.datetime.now() - datetime.datetime.fromtimestamp(mtime)
+  eprint(f"- Known missing since {age} ago")
+  return age < MISS_TTL
 
 
+def store_missing_cache(key: str):
+  with open_cache(f"{key}.miss", "wb"):
+    pass
+
+
+@functools.lru_cache(maxsize=64)
 def get_week(date: datetime.date) -> str:
   week = date.strftime("%Yw%W")
   if week.endswith("w00"):
@@ -162,14 +227,18 @@ def is_current_week(date: datetime.date):
   return get_week(date) == get_week(today)
 
 
+_NUMERIC_DATE_RE = re.compile(r'\d{1,2}/\d{1,2}(/\d{2,4})?')
+
 def get_date(day: str):
   today = datetime.date.today()
 
-  if day == "today":
+  keyword = day.lower()
+
+  if keyword == "today":
     return today
-  elif day == "tomorrow":
+  elif keyword == "tomorrow":
     return today + datetime.timedelta(days=1)
-  elif day == "yesterday":
+  elif keyword == "yesterday":
     return today - datetime.timedelta(days=1)
 
   def parse_with_format(day: str, format: str, defaults: str):
@@ -180,15 +249,23 @@ def get_date(day: str):
     except ValueError as err:
       eprint("Parse attempt:", err)
       return None
-  
-  formats: list[tuple[str, str]] = [
-    # User input , Today
-    ( "%a"       , "%W %Y" ),
-    ( "%A"       , "%W %Y" ),
-    ( "%d/%m"    , "%Y"    ),
-    ( "%d/%m/%y" , ""      ),
-    ( "%d/%m/%Y" , ""      ),
-  ]
+
+  formats: list[tuple[str, str]]
+
+  # Only try the formats that can possibly match the input
+  if _NUMERIC_DATE_RE.fullmatch(day):
+    formats = [
+      # User input , Today
+      ( "%d/%m/%Y" , ""      ),
+      ( "%d/%m/%y" , ""      ),
+      ( "%d/%m"    , "%Y"    ),
+    ]
+  else:
+    formats = [
+      # User input , Today
+      ( "%a"       , "%W %Y" ),
+      ( "%A"       , "%W %Y" ),
+    ]
 
   for format, defaults in formats:
     parsed = parse_with_format(day, format, defaults)
@@ -212,18 +289,71 @@ def get_date(day: str):
   raise ValueError("Unable to parse input date")
 
 
-def get_restaurant_code(search: str):
-  eprint(f"Search term = {search.upper()}")
-  
-  def compare(entry: tuple[int, str]):
-    ratio = difflib.SequenceMatcher(None, search.upper(), entry[1]).ratio()
-    eprint(f"{entry[1]:40} {ratio}")
-    return ratio
+def char_masks(text: str) -> dict[str, int]:
+  # Bit i of masks[c] is set when text[i] == c
+  masks = {}
+  for i, char in enumerate(text):
+    masks[char] = masks.get(char, 0) | 1 << i
+  return masks
+
+
+_RESTAURANT_MASKS = [char_masks(name) for name in restaurants]
+
+def indel_ratio(search: str, index: int) -> float:
+  # Same score as rapidfuzz's fuzz.ratio, so both matchers pick the same
+  # restaurant. The longest common subsequence is computed bit-parallel
+  # (Hyyrö) against the name's precomputed masks, one step per search char
+  name = restaurants[index]
+  masks = _RESTAURANT_MASKS[index]
+  full = (1 << len(name)) - 1
+
+  row = full
+  for char in search:
+    matches = row & masks.get(char, 0)
+    row = ((row + matches) | (row - matches)) & full
+  common = len(name) - bin(row).count("1")
+
+  total = len(search) + len(name)
+  if total == 0:
+    return 100.0
+  return 100 * (1 - (total - 2 * common) / total)
+
+
+@functools.lru_cache(maxsize=32)
+def find_restaurant_code(search: str) -> int:
+  try:
+    from rapidfuzz import fuzz, process
+  except ImportError:
+    process = None
+
+  if process is not None:
+    name, ratio, index = process.extractOne(
+      search, restaurants, scorer=fuzz.ratio
+    )
+    eprint(f"{name:40} {ratio}")
+  else:
+    scores = [indel_ratio(search, i) for i in range(len(restaurants))]
+    for name, ratio in zip(restaurants, scores):
+      eprint(f"{name:40} {ratio}")
+    index = max(range(len(scores)), key=scores.__getitem__)
+    ratio = scores[index]
 
-  return max(enumerate(restaurants), key=compare)[0] + 1
+  # Nothing in common with any name, e.g. an empty search term
+  if ratio == 0:
+    raise ValueError(f'No restaurant matches "{search}"')
+
+  return index + 1
+
+
+def get_restaurant_code(search: str) -> int:
+  search = search.upper()
+  eprint(f"Search term = {search}")
+  return find_restaurant_code(search)
 
 
 def parse_args():
+  import argparse
+
   global verbose_mode
 
   parser = argparse.ArgumentParser(
@@ -239,13 +369,13 @@ def parse_args():
     '-m', '--meal',
     type=lambda s: s.lower(),
     choices=['l', 'lunch', 'd', 'dinner', 'a', 'all'],
-    default='dinner',
+    default=DEFAULT_MEAL,
     help="Meal of the day to fetch the menu for."
   )
   parser.add_argument(
     '-r', '--restaurant',
-    type=str, default='each',
-    help="Name of the restaurant to fetch the menu for."
+    type=str, default=None,
+    help="Name of the restaurant to fetch the menu for. Defaults to EACH."
   )
   parser.add_argument(
     '-w', '--week',
@@ -270,36 +400,47 @@ def parse_args():
   day: datetime.date = get_date(parsed.day)
   meal: str = parsed.meal[0]
   week: bool = parsed.week
-  json: bool = parsed.json
+  as_json: bool = parsed.json
   eprint("=== Parsing restaurant...")
-  restaurant = get_restaurant_code(parsed.restaurant)
+  if parsed.restaurant is None:
+    restaurant = DEFAULT_RESTAURANT
+  else:
+    restaurant = get_restaurant_code(parsed.restaurant)
 
   eprint("ARGS:", (day, meal, restaurant))
 
-  return (json, restaurant, day, meal, week)
+  return (as_json, restaurant, day, meal, week)
+
 
+def week_dates(day: datetime.date) -> list[datetime.date]:
+  # Monday to Friday of the week containing the given day
+  monday = day - datetime.timedelta(days=day.weekday())
+  return [monday + datetime.timedelta(days=i) for i in range(5)]
 
-def display_day_menu(entries: dict[str], day: datetime.date, meal: str):
+
+def append_day_menu(
+  lines: list[str], entries: dict[str], day: datetime.date, meal: str
+):
   date = day.strftime("%d/%m/%Y")
   weekday = day.strftime("%A")
-  print(f"\033[1;93m## {weekday} ({date})\033[m")
+  lines.append(f"\033[1;93m## {weekday} ({date})\033[m")
   if meal == "l" or meal == "a":
-    print("\033[1;93m### Lunch:\033[m")
-    print(entries[f"{date}-lunch"]['menu'])
-    calories = entries[f"{date}-lunch"]['calories']
-    print(f"\n\033[1mCalories: {calories} Kcal\033[m")
+    lines.append("\033[1;93m### Lunch:\033[m")
+    lunch = entries[f"{date}-lunch"]
+    lines.append(lunch['menu'])
+    lines.append(f"\n\033[1mCalories: {lunch['calories']} Kcal\033[m")
   if meal == "d" or meal == "a":
-    print("\033[1;93m### Dinner:\033[m")
-    print(entries[f"{date}-dinner"]['menu'])
-    calories = entries[f"{date}-dinner"]['calories']
-    print(f"\n\033[1mCalories: {calories} Kcal\033[m")
+    lines.append("\033[1;93m### Dinner:\033[m")
+    dinner = entries[f"{date}-dinner"]
+    lines.append(dinner['menu'])
+    lines.append(f"\n\033[1mCalories: {dinner['calories']} Kcal\033[m")
 
 
-def display_week_menu(entries: dict[str], day: datetime.date, meal: str):
-  week = day.strftime("%W-%Y")
-  for weekday in range(1, 6):
-    date = datetime.datetime.strptime(f"{weekday}-{week}", "%w-%W-%Y").date()
-    display_day_menu(entries, date, meal)
+def append_week_menu(
+  lines: list[str], entries: dict[str], day: datetime.date, meal: str
+):
+  for date in week_dates(day):
+    append_day_menu(lines, entries, date, meal)
 
 
 def day_menu_object(entries: dict[str], day: datetime.date, meal: str):
@@ -320,26 +461,33 @@ def day_menu_object(entries: dict[str], day: datetime.date, meal: str):
 
 
 def week_menu_object(entries: dict[str], day: datetime.date, meal: str):
-  week = day.strftime("%W-%Y")
-
-  return [
-    day_menu_object(entries, date, meal)
-    for date in (
-      datetime.datetime.strptime(f"{weekday}-{week}", "%w-%W-%Y").date()
-      for weekday in range(1, 6)
-    )
-  ]
+  return [day_menu_object(entries, date, meal) for date in week_dates(day)]
 
 
 def display_pretty(entries: dict[str], options: tuple):
   restaurant, day, meal, week = options
 
-  print(f"\033[1;93m# {restaurants[restaurant - 1]}\033[m")
+  lines = [f"\033[1;93m# {restaurants[restaurant - 1]}\033[m"]
+
+  # Write everything at once instead of one print per line, including
+  # whatever was built before a missing entry raised
+  try:
+    if week:
+      append_week_menu(lines, entries, day, meal)
+    else:
+      append_day_menu(lines, entries, day, meal)
+  finally:
+    sys.stdout.write("\n".join(lines) + "\n")
 
-  if week:
-    display_week_menu(entries, day, meal)
-  else:
-    display_day_menu(entries, day, meal)
+
+def json_dumps(data) -> str:
+  try:
+    import orjson
+  except ImportError:
+    import json
+    return json.dumps(data, indent=2, ensure_ascii=False)
+
+  return orjson.dumps(data, option=orjson.OPT_INDENT_2).decode()
 
 
 def display_json(entries: dict[str], options: tuple):
@@ -354,11 +502,17 @@ def display_json(entries: dict[str], options: tuple):
     )
   }
 
-  print(json.dumps(data, indent=2))
+  print(json_dumps(data))
 
 
 def main():
-  json, restaurant, day, *options = parse_args()
+  if len(sys.argv) == 1:
+    # No arguments: same as the parser defaults, without building the parser
+    as_json, restaurant, day, *options = (
+      False, DEFAULT_RESTAURANT, datetime.date.today(), DEFAULT_MEAL[0], False
+    )
+  else:
+    as_json, restaurant, day, *options = parse_args()
 
   key = cache_key(day, restaurant)
   entries = fetch_entries_cached(key)
@@ -367,16 +521,21 @@ def main():
     if not is_current_week(day):
       print("Unable to fetch menu for the requested date.")
       return 1
+
+    if is_known_missing(key):
+      print("Failed to fetch menu for the requested restaurant.")
+      return 1
   
     entries = fetch_entries_http(restaurant)
   
     if not entries:
+      store_missing_cache(key)
       print("Failed to fetch menu for the requested restaurant.")
       return 1
 
     store_entries_cache(key, entries)
   
-  if json:
+  if as_json:
     display_json(entries, (restaurant, day, *options))
   else:
     display_pretty(entries, (restaurant, day, *options))